@@ -1,17 +1,25 @@
+import logging
 import unittest
 
+from unittest.mock import patch
 
+from windowsdnsserver.command_runner.powershell_runner import PowerShellRunner
 from windowsdnsserver.dns.dnsserver import DnsServerModule
 from windowsdnsserver.dns.record import RecordType
 
 
 class TestDnsServer(unittest.TestCase):
+    test_dns_zone = "myzone.com"
+    test_dns_name = "www"
 
-    def setUp(self):
-        self.dns = DnsServerModule()
+    @classmethod
+    def setUpClass(cls):
+        # shared by all tests, so that a single PowerShell host serves the whole class
+        cls.dns = DnsServerModule()
 
-        self.test_dns_zone = "myzone.com"
-        self.test_dns_name = "www"
+    @classmethod
+    def tearDownClass(cls):
+        cls.dns.runner.close()
 
     def test_get_dns_records(self):
         success = self.dns.add_a_record(self.test_dns_zone, self.test_dns_name, "100.100.100.100")
@@ -38,5 +46,23 @@ class TestDnsServer(unittest.TestCase):
         self.assertTrue(success)
 
 
+class TestDefaultConstruction(unittest.TestCase):
+
+    def test_powershell_runner(self):
+        runner = PowerShellRunner()
+
+        self.assertIsInstance(runner.logger, logging.Logger)
+        self.assertIsNone(runner.proc)
+
+    def test_dns_server_module(self):
+        # the PowerShell host starts on the first command, so construction works on any platform
+        with patch('windowsdnsserver.dns.dnsserver.PLATFORM_SYSTEM', 'Windows'):
+            dns = DnsServerModule()
+
+        self.assertIsInstance(dns.logger, logging.Logger)
+        self.assertIsInstance(dns.runner, PowerShellRunner)
+        self.assertIs(dns.runner.logger, dns.logger)
+
+
 if __name__ == '__main__':
     unittest.main()
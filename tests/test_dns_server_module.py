@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import subprocess
+import unittest
+
+from unittest.mock import patch
+
+from windowsdnsserver.command_runner.powershell_runner import PowerShellRunner, PowerShellRunnerPool
+from windowsdnsserver.command_runner.runner import CommandRunner, Result
+from windowsdnsserver.dns.dnsserver import DnsServerModule
+from windowsdnsserver.dns.record import RecordType
+
+
+class TestDnsServerModule(unittest.TestCase):
+
+    def setUp(self):
+        # DnsServerModule refuses to start on other platforms, commands are mocked anyway
+        platform_patch = patch('windowsdnsserver.dns.dnsserver.PLATFORM_SYSTEM', 'Windows')
+        platform_patch.start()
+        self.addCleanup(platform_patch.stop)
+
+        run_patch = patch('windowsdnsserver.dns.dnsserver.DnsServerModule.run')
+        self.run_mock = run_patch.start()
+        self.addCleanup(run_patch.stop)
+
+        self.dns = DnsServerModule()
+        self.operations = [
+            self.dns._build_add_op(RecordType.A, 'myzone.com', 'www', '10.0.0.1'),
+            self.dns._build_add_op(RecordType.A, 'myzone.com', 'mail', '10.0.0.2'),
+        ]
+
+    def test_apply_batch(self):
+        self.run_mock.return_value = Result(False, 1, '[true,false]', '')
+
+        with patch.object(self.dns, '_log_failure') as log_failure:
+            self.assertEqual(self.dns.apply_batch(self.operations), [True, False])
+
+        # only the failed operation is logged, not the whole batch
+        log_failure.assert_called_once()
+        self.assertEqual(log_failure.call_args[0][0].args['Name'], 'mail')
+
+        command = self.run_mock.call_args[0][0]
+        self.assertIn('| Out-Null; $true } catch { $false }', command.cmdlet)
+        self.assertEqual(self.run_mock.call_args[1], {'log_failure': False})
+
+    def test_apply_batch_single_operation(self):
+        self.run_mock.return_value = Result(True, 0, 'true', '')
+
+        self.assertEqual(self.dns.apply_batch(self.operations[:1]), [True])
+
+    def test_apply_batch_empty_output(self):
+        self.run_mock.return_value = Result(False, 1, '', 'host failed')
+
+        self.assertEqual(self.dns.apply_batch(self.operations), [False, False])
+
+    def test_apply_batch_length_mismatch(self):
+        self.run_mock.return_value = Result(True, 0, '[true,true,true]', '')
+
+        self.assertEqual(self.dns.apply_batch(self.operations), [False, False])
+
+    def test_apply_batch_above_command_line_limit(self):
+        def run(command, log_failure=True):
+            # one success marker per operation in the chunk
+            return Result(True, 0, json.dumps([True] * command.cmdlet.count('$true')), '')
+
+        self.run_mock.side_effect = run
+
+        operations = [self.dns._build_add_op(RecordType.A, 'myzone.com', 'host%s' % i, '10.0.0.1')
+                      for i in range(200)]
+        self.assertEqual(self.dns.apply_batch(operations), [True] * 200)
+        self.assertGreater(self.run_mock.call_count, 1)
+
+        runner = PowerShellRunner(persistent=False)
+        for call in self.run_mock.call_args_list:
+            command_line = subprocess.list2cmdline(runner._build_process_command(call[0][0]))
+            self.assertLess(len(command_line), 32767)
+
+    def test_apply_batch_no_operations(self):
+        self.assertEqual(self.dns.apply_batch([]), [])
+        self.run_mock.assert_not_called()
+
+    def test_get_dns_record_batch(self):
+        with open(os.path.join(os.path.dirname(__file__), 'mock_data.json')) as fd:
+            self.run_mock.return_value = Result(True, 0, json.load(fd)['GetDnsServerResponse1'], '')
+
+        batch = self.dns.get_dns_record_batch('myzone.com')
+        self.assertEqual(batch.zone, 'myzone.com')
+        self.assertEqual(batch.contents, ['34.65.234.38'])
+
+        self.run_mock.return_value = Result(False, 1, '', 'failed')
+        self.assertEqual(len(self.dns.get_dns_record_batch('myzone.com')), 0)
+
+    def test_cache_ignores_name_case(self):
+        self.run_mock.return_value = Result(True, 0, '', '')
+
+        self.dns.get_dns_records('myzone.com', 'www')
+        self.dns.get_dns_records('MyZone.com', 'WWW')
+        self.assertEqual(self.run_mock.call_count, 1)
+
+        self.dns.add_a_record('MyZone.com', 'WWW', '10.0.0.1')
+        self.dns.get_dns_records('myzone.com', 'www')
+        self.assertEqual(self.run_mock.call_count, 3)
+
+    def test_module_installed_is_memoized(self):
+        self.run_mock.return_value = Result(True, 0, 'DnsServer module', '')
+
+        self.assertTrue(self.dns.is_dns_server_module_installed())
+        self.assertTrue(self.dns.is_dns_server_module_installed())
+        self.assertEqual(self.run_mock.call_count, 1)
+
+    def test_module_installed_failed_check_is_not_memoized(self):
+        self.run_mock.return_value = Result(False, 1, '', 'timed out')
+        self.assertFalse(self.dns.is_dns_server_module_installed())
+
+        self.run_mock.return_value = Result(True, 0, 'DnsServer module', '')
+        self.assertTrue(self.dns.is_dns_server_module_installed())
+        self.assertEqual(self.run_mock.call_count, 2)
+
+
+class RecordingRunner(CommandRunner):
+
+    def __init__(self):
+        self.commands = []
+
+    def run(self, command):
+        self.commands.append(command)
+        return Result(command.args.get('Name') != 'fail', 0, '', '')
+
+    async def run_async(self, command):
+        return self.run(command)
+
+
+class TestAsyncMethods(unittest.TestCase):
+    # sync method, its asyncio twin and their arguments
+    methods = [
+        ('get_dns_records', 'aget_dns_records', ('myzone.com', 'www', RecordType.A)),
+        ('add_a_record', 'aadd_a_record', ('myzone.com', 'www', '10.0.0.1', '1h')),
+        ('remove_a_record', 'aremove_a_record', ('myzone.com', 'www')),
+        ('add_cname_record', 'aadd_cname_record', ('myzone.com', 'alias', 'www.myzone.com', '1h')),
+        ('remove_cname_record', 'aremove_cname_record', ('myzone.com', 'alias')),
+        ('add_txt_record', 'aadd_txt_record', ('myzone.com', 'www', 'my test record', '30m')),
+        ('remove_txt_record', 'aremove_txt_record', ('myzone.com', 'www', 'my test record')),
+    ]
+
+    def setUp(self):
+        platform_patch = patch('windowsdnsserver.dns.dnsserver.PLATFORM_SYSTEM', 'Windows')
+        platform_patch.start()
+        self.addCleanup(platform_patch.stop)
+
+    def test_async_methods_match_sync_methods(self):
+        for sync_method, async_method, args in self.methods:
+            with self.subTest(async_method):
+                sync_runner = RecordingRunner()
+                sync_result = getattr(DnsServerModule(runner=sync_runner, cache_ttl=0), sync_method)(*args)
+
+                async_runner = RecordingRunner()
+                dns = DnsServerModule(runner=async_runner, cache_ttl=0)
+                async_result = asyncio.run(getattr(dns, async_method)(*args))
+
+                self.assertEqual(async_result, sync_result)
+                self.assertEqual([command.build() for command in async_runner.commands],
+                                 [command.build() for command in sync_runner.commands])
+
+
+class TestAddARecordsBulk(unittest.TestCase):
+    items = [('myzone.com', 'www', '10.0.0.1'), ('myzone.com', 'fail', '10.0.0.2', '1h')]
+
+    def setUp(self):
+        platform_patch = patch('windowsdnsserver.dns.dnsserver.PLATFORM_SYSTEM', 'Windows')
+        platform_patch.start()
+        self.addCleanup(platform_patch.stop)
+
+    def test_serial(self):
+        runner = RecordingRunner()
+        dns = DnsServerModule(runner=runner)
+
+        self.assertEqual(dns.add_a_records_bulk(self.items), [True, False])
+        self.assertEqual([command.args['Name'] for command in runner.commands], ['www', 'fail'])
+        self.assertEqual(runner.commands[1].args['TimeToLive'], '01:00:00')
+
+    def test_pool(self):
+        recording = RecordingRunner()
+        pool = PowerShellRunnerPool(size=2)
+        self.addCleanup(pool.close)
+
+        with patch.object(PowerShellRunner, 'run', autospec=True,
+                          side_effect=lambda runner, command: recording.run(command)):
+            dns = DnsServerModule(runner=pool)
+            self.assertEqual(dns.add_a_records_bulk(self.items), [True, False])
+
+        self.assertEqual(sorted(command.args['Name'] for command in recording.commands), ['fail', 'www'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import os
 import unittest
 import json
 
@@ -6,7 +7,7 @@ from unittest.mock import patch
 from windowsdnsserver.command_runner.runner import Result
 from windowsdnsserver.dns.dnsserver import DnsServerModule
 from windowsdnsserver.dns.record import RecordType
-from windowsdnsserver.util.dns_server_utils import parse_ttl, format_ttl
+from windowsdnsserver.util.dns_server_utils import parse_ttl, format_ttl, transform_dns_server_result_to_batch
 
 
 class TestDnsServerUtils(unittest.TestCase):
@@ -14,7 +15,8 @@ class TestDnsServerUtils(unittest.TestCase):
     def test_convert_dns_server(self):
         mock_data = self.load_mock_data()
 
-        with patch('windowsdnsserver.dns.dnsserver.DnsServerModule.run') as mock:
+        with patch('windowsdnsserver.dns.dnsserver.PLATFORM_SYSTEM', 'Windows'), \
+                patch('windowsdnsserver.dns.dnsserver.DnsServerModule.run') as mock:
             mock.return_value = Result(True, 0, mock_data['GetDnsServerResponse1'], '')
 
             dns = DnsServerModule()
@@ -28,6 +30,41 @@ class TestDnsServerUtils(unittest.TestCase):
             self.assertEqual(result.type, RecordType.A)
             self.assertEqual(result.content, '34.65.234.38')
 
+    def test_get_dns_records_cache(self):
+        mock_data = self.load_mock_data()
+
+        with patch('windowsdnsserver.dns.dnsserver.PLATFORM_SYSTEM', 'Windows'), \
+                patch('windowsdnsserver.dns.dnsserver.DnsServerModule.run') as mock:
+            mock.return_value = Result(True, 0, mock_data['GetDnsServerResponse1'], '')
+
+            dns = DnsServerModule()
+            dns.get_dns_records("zone")
+            dns.get_dns_records("zone")
+            self.assertEqual(mock.call_count, 1)
+
+            dns.remove_a_record("zone", "@")
+            dns.get_dns_records("zone")
+            self.assertEqual(mock.call_count, 3)
+
+    def test_transform_dns_server_result_to_batch(self):
+        cmdlet_result = json.loads(self.load_mock_data()['GetDnsServerResponse1'])
+
+        batch = transform_dns_server_result_to_batch("zone", cmdlet_result)
+        self.assertEqual(batch.zone, "zone")
+        self.assertEqual(batch.names, ['@'])
+        self.assertEqual(batch.types, [RecordType.A])
+        self.assertEqual(batch.contents, ['34.65.234.38'])
+        self.assertEqual(batch.ttls, ['1h'])
+
+        # a list of records and unsupported record types
+        unsupported = dict(cmdlet_result, RecordType='SOA')
+        batch = transform_dns_server_result_to_batch("zone", [cmdlet_result, unsupported, cmdlet_result])
+        self.assertEqual(len(batch), 2)
+
+        # any iterable of records
+        batch = transform_dns_server_result_to_batch("zone", (r for r in [cmdlet_result, cmdlet_result]))
+        self.assertEqual(batch.contents, ['34.65.234.38', '34.65.234.38'])
+
     def test_parse_ttl(self):
         def mock_time_to_live(h, m, s):
             mock = dict()
@@ -83,7 +120,7 @@ class TestDnsServerUtils(unittest.TestCase):
             format_ttl('100s')
 
     def load_mock_data(self):
-        fd = open('/tests/mock_data.json')
+        fd = open(os.path.join(os.path.dirname(__file__), 'mock_data.json'))
         r = json.load(fd)
         fd.close()
         return r
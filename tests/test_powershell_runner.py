@@ -0,0 +1,312 @@
+import asyncio
+import io
+import os
+import queue
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from unittest.mock import patch
+
+from windowsdnsserver.command_runner.powershell_runner import PowerShellCommand, PowerShellRunner, \
+    PowerShellRunnerPool, quote_argument
+from windowsdnsserver.command_runner.runner import Result
+
+# stands in for powershell.exe in persistent mode: decodes the script of each command line and
+# echoes it, 'Exit-Host' exits without writing the markers, 'Wait-Forever' never answers
+FAKE_HOST = """#!%s
+import base64, re, sys, time
+
+for line in sys.stdin:
+    if line.strip() == 'exit':
+        break
+
+    encoded = re.search(r"FromBase64String\\('([^']*)'\\)", line).group(1)
+    script = base64.b64decode(encoded).decode('utf-16-le')
+
+    if script.startswith('Exit-Host'):
+        sys.exit(3)
+    if script.startswith('Wait-Forever'):
+        time.sleep(60)
+
+    sys.stdout.write(script + '\\n')
+    sys.stderr.write('<<<EOF>>>\\n')
+    sys.stderr.flush()
+    sys.stdout.write('<<<EOF:0>>>\\n')
+    sys.stdout.flush()
+""" % sys.executable
+
+# stands in for powershell.exe in per-command mode: echoes its arguments, or hangs when asked to
+FAKE_PROCESS = """#!%s
+import sys, time
+
+if sys.argv[-1] == 'hang':
+    time.sleep(60)
+
+print(' '.join(sys.argv[1:]))
+""" % sys.executable
+
+
+def create_script(content):
+    fd, path = tempfile.mkstemp(suffix='.py')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+class TestPowerShellCommand(unittest.TestCase):
+
+    def test_build(self):
+        command = PowerShellCommand('Remove-DnsServerResourceRecord', 'Force', ZoneName='myzone.com')
+
+        self.assertEqual(command.build(), ['Remove-DnsServerResourceRecord', '-Force', '-ZoneName', "'myzone.com'"])
+
+    def test_build_quotes_values(self):
+        command = PowerShellCommand('Add-DnsServerResourceRecord', DescriptiveText="it's my $record")
+
+        self.assertEqual(command.build(), ['Add-DnsServerResourceRecord', '-DescriptiveText', "'it''s my $record'"])
+
+    def test_build_is_memoized(self):
+        command = PowerShellCommand('Get-DnsServerResourceRecord', ZoneName='myzone.com')
+
+        with patch('windowsdnsserver.command_runner.powershell_runner.quote_argument',
+                   wraps=quote_argument) as quote:
+            self.assertEqual(command.build(), command.build())
+        self.assertEqual(quote.call_count, 1)
+
+        # callers get their own copy
+        command.build().append('junk')
+        self.assertNotIn('junk', command.build())
+
+        # changes of the command are picked up
+        command.args['Name'] = 'www'
+        self.assertEqual(command.build()[-2:], ['-Name', "'www'"])
+
+    def test_build_json_convert(self):
+        command = PowerShellCommand('Get-DnsServerResourceRecord', to_json_convert=True, ZoneName='myzone.com')
+
+        self.assertEqual(command.build()[-3:], ['|', 'ConvertTo-Json', '-Compress'])
+
+    def test_quote_argument(self):
+        self.assertEqual(quote_argument('www'), "'www'")
+        self.assertEqual(quote_argument(3600), "'3600'")
+        self.assertEqual(quote_argument("a'b"), "'a''b'")
+        self.assertEqual(quote_argument('a\u2019b'), "'a\u2019\u2019b'")
+
+    def test_invalid_flags_and_args(self):
+        with self.assertRaisesRegex(AssertionError, 'flag must be a string'):
+            PowerShellCommand('Add-DnsServerResourceRecordA', 'AllowUpdateAny', 1)
+
+        with self.assertRaisesRegex(AssertionError, r'argument \[Name\] has no value'):
+            PowerShellCommand('Add-DnsServerResourceRecordA', ZoneName='myzone.com', Name=None)
+
+
+class TestPowerShellRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = PowerShellRunner()
+
+    def test_read_output(self):
+        stream = io.BytesIO(b'first\nsecond\n<<<EOF:1>>>\nnext command\n')
+
+        code, out = self.runner._read_output(stream)
+        self.assertEqual(code, 1)
+        self.assertEqual(out, 'first\nsecond\n')
+
+        # rest of the stream belongs to the next command
+        self.assertEqual(stream.read(), b'next command\n')
+
+    def test_read_output_host_exited(self):
+        code, out = self.runner._read_output(io.BytesIO(b'partial\n'))
+
+        self.assertIsNone(code)
+        self.assertEqual(out, 'partial\n')
+
+    def test_read_errors(self):
+        lines = queue.Queue()
+        for line in (b'error 1\n', b'error 2\n', b'<<<EOF>>>\n', b'next command\n'):
+            lines.put(line)
+
+        self.assertEqual(self.runner._read_errors(lines), 'error 1\nerror 2\n')
+        self.assertEqual(lines.get_nowait(), b'next command\n')
+
+    def test_read_errors_host_exited(self):
+        lines = queue.Queue()
+        lines.put(b'error\n')
+        lines.put(None)
+
+        self.assertEqual(self.runner._read_errors(lines), 'error\n')
+
+
+@unittest.skipIf(os.name == 'nt', "fake host is started as a script")
+class TestPersistentHost(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake_host = create_script(FAKE_HOST)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.fake_host)
+
+    def setUp(self):
+        self.runner = PowerShellRunner(self.fake_host, timeout=2)
+
+    def tearDown(self):
+        self.runner.close()
+
+    def test_run(self):
+        result = self.runner.run(PowerShellCommand('Get-DnsServerResourceRecord', ZoneName='myzone.com'))
+
+        self.assertTrue(result.success)
+        self.assertEqual(result.out, "Get-DnsServerResourceRecord -ZoneName 'myzone.com'\n")
+
+        # same host serves the next command
+        proc = self.runner.proc
+        self.assertTrue(self.runner.run(PowerShellCommand('Get-Module')).success)
+        self.assertIs(self.runner.proc, proc)
+
+    def test_run_multiline_and_non_ascii_values(self):
+        result = self.runner.run(PowerShellCommand('Add-DnsServerResourceRecord', DescriptiveText='line 1\nşçö'))
+
+        self.assertTrue(result.success)
+        self.assertIn("'line 1\nşçö'", result.out)
+
+    def test_restart_after_host_exited(self):
+        self.runner.run(PowerShellCommand('Get-Module'))
+        proc = self.runner.proc
+
+        result = self.runner.run(PowerShellCommand('Exit-Host'))
+        self.assertFalse(result.success)
+        self.assertEqual(result.code, 3)
+        self.assertIsNone(self.runner.proc)
+
+        self.assertTrue(self.runner.run(PowerShellCommand('Get-Module')).success)
+        self.assertIsNot(self.runner.proc, proc)
+
+    def test_timeout_kills_host(self):
+        result = self.runner.run(PowerShellCommand('Wait-Forever'))
+        self.assertFalse(result.success)
+        self.assertIsNone(self.runner.proc)
+
+        self.assertTrue(self.runner.run(PowerShellCommand('Get-Module')).success)
+
+
+@unittest.skipIf(os.name == 'nt', "fake process is started as a script")
+class TestRunAsync(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake_process = create_script(FAKE_PROCESS)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.fake_process)
+
+    def setUp(self):
+        self.runner = PowerShellRunner(self.fake_process, persistent=False, timeout=1)
+        self.plain_arguments = patch.object(self.runner, '_build_process_command', wraps=self.build_command)
+
+    def build_command(self, command):
+        # last argument tells the fake process what to do
+        return [self.fake_process, command.cmdlet]
+
+    def test_run_async(self):
+        result = asyncio.run(self.runner.run_async(PowerShellCommand('Get-Module')))
+
+        self.assertTrue(result.success)
+        self.assertIn('-EncodedCommand', result.out)
+
+    def test_timeout_kills_process(self):
+        with self.plain_arguments:
+            result = asyncio.run(self.runner.run_async(PowerShellCommand('hang')))
+
+        self.assertFalse(result.success)
+
+    def test_cancel_kills_process(self):
+        processes = []
+        create_subprocess_exec = asyncio.create_subprocess_exec
+
+        async def capture_process(*args, **kwargs):
+            proc = await create_subprocess_exec(*args, **kwargs)
+            processes.append(proc)
+            return proc
+
+        async def run_and_cancel():
+            task = asyncio.ensure_future(self.runner.run_async(PowerShellCommand('hang')))
+            while not processes:
+                await asyncio.sleep(0.01)
+
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+            # killed right away, not after the fake process finishes sleeping
+            await asyncio.wait_for(processes[0].wait(), 5)
+            return processes[0].returncode
+
+        with self.plain_arguments, patch('asyncio.create_subprocess_exec', capture_process):
+            self.assertIsNotNone(asyncio.run(run_and_cancel()))
+
+
+class TestPowerShellRunnerPool(unittest.TestCase):
+
+    def setUp(self):
+        run_patch = patch.object(PowerShellRunner, 'run', autospec=True, side_effect=self.fake_run)
+        run_patch.start()
+        self.addCleanup(run_patch.stop)
+
+        self.pool = PowerShellRunnerPool(size=3)
+        self.addCleanup(self.pool.close)
+
+    @staticmethod
+    def fake_run(runner, command):
+        if command.cmdlet == 'Fail-Command':
+            raise RuntimeError("host failed")
+
+        # later commands finish first, results must still match the submission order
+        time.sleep(0.01 * (10 - int(command.args.get('Index', 0))))
+        return Result(True, 0, command.args.get('Index', ''), '')
+
+    def test_submit_keeps_order(self):
+        futures = [self.pool.submit(PowerShellCommand('Get-Index', Index=i)) for i in range(10)]
+
+        self.assertEqual([future.result().out for future in futures], list(range(10)))
+
+    def test_runs_concurrently(self):
+        threads = set()
+
+        def record_thread(runner, command):
+            threads.add(threading.current_thread())
+            time.sleep(0.05)
+            return Result(True, 0, '', '')
+
+        PowerShellRunner.run.side_effect = record_thread
+        futures = [self.pool.submit(PowerShellCommand('Get-Module')) for _ in range(3)]
+        for future in futures:
+            future.result()
+
+        self.assertEqual(len(threads), 3)
+
+    def test_runner_is_returned_after_exception(self):
+        with self.assertRaises(RuntimeError):
+            self.pool.run(PowerShellCommand('Fail-Command'))
+
+        self.assertEqual(self.pool._runners.qsize(), 3)
+        self.assertTrue(self.pool.run(PowerShellCommand('Get-Index', Index=1)).success)
+
+    def test_close(self):
+        with patch.object(PowerShellRunner, 'close', autospec=True) as close:
+            self.pool.close()
+
+        self.assertEqual(close.call_count, 3)
+        with self.assertRaises(RuntimeError):
+            self.pool.submit(PowerShellCommand('Get-Module'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 import unittest
 
-from windowsdnsserver.dns.record import RecordType
+from windowsdnsserver.dns.record import Record, RecordBatch, RecordType
 from windowsdnsserver.util import dns_server_utils
 
 
@@ -22,6 +22,35 @@ class TestRecords(unittest.TestCase):
 
         self.assertEqual(RecordType.TXT, record_type_txt)
 
+    def test_record_is_read_only(self):
+        record = Record('myzone.com', 'www', RecordType.A, '10.0.0.1')
+
+        with self.assertRaisesRegex(AttributeError, 'read-only'):
+            record.content = '10.0.0.2'
+
+        with self.assertRaisesRegex(AttributeError, 'read-only'):
+            del record.ttl
+
+        self.assertEqual(record.content, '10.0.0.1')
+
+    def test_record_batch(self):
+        records = [
+            Record('myzone.com', 'www', RecordType.A, '10.0.0.1', '1h'),
+            Record('myzone.com', 'mail', RecordType.TXT, 'my test record', '30m'),
+        ]
+
+        batch = RecordBatch.from_records('myzone.com', records)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.names, ['www', 'mail'])
+        self.assertEqual(batch.types, [RecordType.A, RecordType.TXT])
+
+        self.assertIsInstance(batch, RecordBatch)
+
+        record = list(batch.records())[1]
+        self.assertEqual(record.zone, 'myzone.com')
+        self.assertEqual(record.content, 'my test record')
+        self.assertEqual(record.ttl, '30m')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,24 +1,86 @@
-import platform
+import asyncio
+import logging
+import queue
+import re
 import subprocess
 import sys
+import tempfile
+import threading
+from base64 import b64encode
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from .runner import Command, CommandRunner, Result
 from ..util import logger
 
 DEFAULT_POWER_SHELL_EXE_PATH = "C:\Windows\syswow64\WindowsPowerShell\\v1.0\powershell.exe"
 
+POWER_SHELL_FLAGS = ('-NoProfile', '-NonInteractive', '-NoLogo', '-ExecutionPolicy', 'Bypass')
+
+# markers written by the persistent host after every command, so that the output
+# of one command can be told apart from the next one on the shared pipes
+END_OF_OUTPUT_MARKER = '<<<EOF:'
+END_OF_ERROR_MARKER = '<<<EOF>>>'
+
+# the script is sent base64 encoded, so the line written to the host is plain ASCII whatever the
+# script contains, ie newlines or non-ASCII text. Parse errors and terminating errors are caught,
+# their message is written before the markers and the markers are always written.
+# $LASTEXITCODE is only set by native executables, cmdlets report failures through $Error
+HOST_COMMAND_TEMPLATE = (
+    "$Error.Clear(); "
+    "try { Invoke-Expression ([Text.Encoding]::Unicode.GetString([Convert]::FromBase64String('%s'))) } "
+    "catch { [Console]::Error.WriteLine($_) } "
+    "finally { "
+    "$__exit_code = if ($Error.Count -gt 0) { 1 } else { 0 }; "
+    "[Console]::Error.WriteLine('" + END_OF_ERROR_MARKER + "'); "
+    "Write-Output ('" + END_OF_OUTPUT_MARKER + "' + $__exit_code + '>>>') }\n"
+)
+
+# PowerShell accepts typographic single quotes as string delimiters too
+SINGLE_QUOTES = re.compile("(['\u2018\u2019\u201a\u201b])")
+
+
+def quote_argument(value) -> str:
+    """
+    quote_argument converts given value to a PowerShell single-quoted string literal,
+    its content is taken verbatim, ie no variable expansion or number parsing
+
+    "my record" -> 'my record'
+
+    "it's" -> 'it''s'
+    """
+    return "'%s'" % SINGLE_QUOTES.sub(r'\1\1', str(value))
+
+
+def encode_script(script: str) -> str:
+    """ base64 of the UTF-16LE script, the format of -EncodedCommand """
+    return b64encode(script.encode('utf-16-le')).decode()
+
 
 class PowerShellCommand(Command):
 
     def __init__(self, cmdlet: str, *flags, to_json_convert=False, **args):
         super().__init__()
 
+        # catches misuse like unpacking an args dict as flags, before a process is spawned
+        for flag in flags:
+            assert isinstance(flag, str), "flag must be a string, actual: [%s]" % flag
+        for arg, value in args.items():
+            assert value is not None, "argument [%s] has no value" % arg
+
         self.cmdlet = cmdlet
         self.flags = flags
         self.args = args
         self.to_json_convert = to_json_convert
 
+        self._built_from = None
+        self._built = None
+
     def build(self):
+        """ builds the command tokens, they are rebuilt only if the command was changed since the last call """
+        built_from = (self.cmdlet, tuple(self.flags), tuple(self.args.items()), self.to_json_convert)
+        if self._built is not None and self._built_from == built_from:
+            return list(self._built)
+
         cmd = [self.cmdlet]
 
         # add flags, ie -Force
@@ -27,20 +89,32 @@ class PowerShellCommand(Command):
 
         # add arguments
         for arg, value in self.args.items():
-            cmd.append('-%s %s' % (arg, value))
+            cmd.append('-' + arg)
+            cmd.append(quote_argument(value))
 
         # convert to json to make machine readable
         if self.to_json_convert:
             cmd.append('|')
             cmd.append('ConvertTo-Json')
+            cmd.append('-Compress')
 
+        self._built_from = built_from
+        self._built = tuple(cmd)
         return cmd
 
 
 class PowerShellRunner(CommandRunner):
+    """
+        Runs PowerShell commands.
+
+        By default, a single powershell.exe process is started on the first command and
+        kept alive, commands are streamed to its stdin. Set persistent to False to spawn
+        a new process per command.
+    """
     encode_command = True
 
-    def __init__(self, power_shell_path: str = None, logger_service=None):
+    def __init__(self, power_shell_path: str = None, logger_service=None, persistent: bool = True,
+                 timeout: int = 60):
         if logger_service is None:
             self.logger = logger.create_logger("PowerShellRunner")
         else:
@@ -50,44 +124,264 @@ class PowerShellRunner(CommandRunner):
         if power_shell_path is None:
             self.power_shell_path = DEFAULT_POWER_SHELL_EXE_PATH
 
+        self.persistent = persistent
+        self.timeout = timeout
+
+        self._enc = sys.stdout.encoding or 'utf-8'
+        self.logger.debug('using default encoding: [%s]', self._enc)
+
+        self.proc = None
+        self._stderr_lines = None
+        self._lock = threading.Lock()
+
     def run(self, command: PowerShellCommand) -> Result:
         assert isinstance(command, PowerShellCommand)
 
-        cmd = command.build()
-        if self.encode_command:
-            (_, ver, _) = platform.python_version_tuple()
-            if int(ver) < 11:
-                from base64 import encodestring
-                encoded_command = encodestring(' '.join(cmd).encode()).decode()
-            else:
-                from base64 import encodebytes
-                command_string = ' '.join(cmd).encode()
-                buf = bytearray()
-                for comand_byte in command_string:
-                    buf.append(comand_byte)
-                    buf.append(0)
-                encoded_command = encodebytes(buf).decode().replace('\n','')
-            cmd = (self.power_shell_path, '-encodedCommand', encoded_command)
-        else:
-            cmd.insert(0, self.power_shell_path)
+        if self.persistent:
+            return self._run_in_host(command)
+
+        return self._run_in_process(command)
+
+    async def run_async(self, command: PowerShellCommand) -> Result:
+        """ runs given command in its own process without blocking the event loop """
+        assert isinstance(command, PowerShellCommand)
 
-        self.logger.debug("Running: [%s]" % ' '.join(cmd))
+        cmd = self._build_process_command(command)
 
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Running: [%s]", ' '.join(cmd))
+
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         try:
-            out, err = proc.communicate(timeout=60)
-        except:
+            out, err = await asyncio.wait_for(proc.communicate(), self.timeout)
+        except asyncio.TimeoutError:
             proc.kill()
-            out, err = proc.communicate()
+            out, err = await proc.communicate()
         finally:
-            pass
+            # ie the awaiting task was cancelled, the process must not outlive it
+            if proc.returncode is None:
+                proc.kill()
+
+        return self._to_result(proc.returncode, out, err)
+
+    def close(self):
+        """ stops the persistent PowerShell host, if it is running """
+        with self._lock:
+            proc = self.proc
+            self.proc = None
+
+            if proc is None:
+                return
+
+            if proc.poll() is not None:
+                self._close_pipes(proc)
+                return
+
+            try:
+                proc.stdin.write(b'exit\n')
+                proc.stdin.flush()
+                proc.wait(timeout=self.timeout)
+            except:
+                proc.kill()
+                proc.wait()
+            finally:
+                self._close_pipes(proc)
+
+    # --
+
+    def _start_host(self):
+        cmd = [self.power_shell_path]
+        cmd.extend(POWER_SHELL_FLAGS)
+        cmd.extend(('-Command', '-'))
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Starting PowerShell host: [%s]", ' '.join(cmd))
+
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # stderr is drained on a separate thread, otherwise the host blocks once the pipe buffer is full
+        self._stderr_lines = queue.Queue()
+        reader = threading.Thread(target=self._drain_stderr, args=(self.proc.stderr, self._stderr_lines))
+        reader.daemon = True
+        reader.start()
+
+    @staticmethod
+    def _close_pipes(proc):
+        # stderr is closed by its reader thread
+        for stream in (proc.stdin, proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _drain_stderr(stream, lines: queue.Queue):
+        for line in iter(stream.readline, b''):
+            lines.put(line)
+
+        # end of stream, host exited
+        stream.close()
+        lines.put(None)
+
+    def _run_in_host(self, command: PowerShellCommand) -> Result:
+        script = ' '.join(command.build())
+
+        with self._lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self._start_host()
+
+            proc = self.proc
+
+            self.logger.debug("Running: [%s]", script)
+
+            watchdog = threading.Timer(self.timeout, proc.kill)
+            watchdog.start()
+            try:
+                proc.stdin.write((HOST_COMMAND_TEMPLATE % encode_script(script)).encode('ascii'))
+                proc.stdin.flush()
+
+                code, out = self._read_output(proc.stdout)
+                err = self._read_errors(self._stderr_lines)
+            except OSError as e:
+                # host is gone, ie killed by the watchdog
+                code, out, err = None, '', str(e)
+            finally:
+                watchdog.cancel()
+
+            if code is None:
+                # host exited before completing the command, next command starts a new one
+                self.proc = None
+                code = proc.wait() or 1
+                self._close_pipes(proc)
 
-        self.logger.debug('using default encoding: [%s]' % sys.stdout.encoding)
+        self.logger.debug("Returned: \n\tout:[%s], \n\terr:[%s]", out, err)
 
-        out = out.decode(sys.stdout.encoding, 'replace')
-        err = err.decode(sys.stdout.encoding, 'replace')
+        success = code == 0
+        return Result(success, code, out, err)
 
-        self.logger.debug("Returned: \n\tout:[%s], \n\terr:[%s]" % (out, err))
+    def _read_output(self, stream):
+        lines = []
+        for line in iter(stream.readline, b''):
+            line = line.decode(self._enc, 'replace')
 
-        success = proc.returncode == 0
-        return Result(success, proc.returncode, out, err)
+            stripped = line.strip()
+            if stripped.startswith(END_OF_OUTPUT_MARKER):
+                code = int(stripped[len(END_OF_OUTPUT_MARKER):-len('>>>')])
+                return code, ''.join(lines)
+
+            lines.append(line)
+
+        return None, ''.join(lines)
+
+    def _read_errors(self, lines: queue.Queue):
+        err = []
+        while True:
+            line = lines.get()
+            if line is None:
+                break
+
+            line = line.decode(self._enc, 'replace')
+            if line.strip() == END_OF_ERROR_MARKER:
+                break
+
+            err.append(line)
+
+        return ''.join(err)
+
+    def _build_process_command(self, command: PowerShellCommand) -> list:
+        script = ' '.join(command.build())
+
+        cmd = [self.power_shell_path]
+        cmd.extend(POWER_SHELL_FLAGS)
+        if self.encode_command:
+            cmd.extend(('-EncodedCommand', encode_script(script)))
+        else:
+            # passed as a single argument, so PowerShell parses it as one script
+            cmd.extend(('-Command', script))
+
+        return cmd
+
+    def _run_in_process(self, command: PowerShellCommand) -> Result:
+        cmd = self._build_process_command(command)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Running: [%s]", ' '.join(cmd))
+
+        # stderr goes to a file instead of a second pipe, so stdout can be read on this thread
+        # without the child blocking on a full stderr pipe, the file is read only on failure
+        with tempfile.TemporaryFile() as err_file:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err_file)
+
+            watchdog = threading.Timer(self.timeout, proc.kill)
+            watchdog.start()
+            try:
+                out = proc.stdout.read()
+                code = proc.wait()
+            finally:
+                watchdog.cancel()
+                proc.stdout.close()
+
+            err = b''
+            if code != 0:
+                err_file.seek(0)
+                err = err_file.read()
+
+        return self._to_result(code, out, err)
+
+    def _to_result(self, code: int, out: bytes, err: bytes) -> Result:
+        out = out.decode(self._enc, 'replace')
+        err = err.decode(self._enc, 'replace')
+
+        self.logger.debug("Returned: \n\tout:[%s], \n\terr:[%s]", out, err)
+
+        success = code == 0
+        return Result(success, code, out, err)
+
+
+class PowerShellRunnerPool(CommandRunner):
+    """
+        Runs PowerShell commands concurrently on a fixed number of persistent PowerShellRunner hosts.
+
+        Each host is started on its first command, so at most size powershell.exe processes are alive.
+    """
+
+    def __init__(self, size: int = 4, power_shell_path: str = None, logger_service=None, timeout: int = 60):
+        assert size > 0, "pool size must be positive"
+
+        if logger_service is None:
+            self.logger = logger.create_logger("PowerShellRunnerPool")
+        else:
+            self.logger = logger_service
+
+        self.size = size
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+        self._runners = queue.Queue()
+        for _ in range(size):
+            self._runners.put(PowerShellRunner(power_shell_path, logger_service=self.logger, timeout=timeout))
+
+    def submit(self, command: PowerShellCommand) -> Future:
+        """ schedules given command on a free host, the future resolves to its Result """
+        assert isinstance(command, PowerShellCommand)
+
+        return self._executor.submit(self._run_on_free_runner, command)
+
+    def run(self, command: PowerShellCommand) -> Result:
+        return self.submit(command).result()
+
+    async def run_async(self, command: PowerShellCommand) -> Result:
+        return await asyncio.wrap_future(self.submit(command))
+
+    def close(self):
+        """ waits for scheduled commands and stops all hosts """
+        self._executor.shutdown(wait=True)
+
+        while not self._runners.empty():
+            self._runners.get_nowait().close()
+
+    def _run_on_free_runner(self, command: PowerShellCommand) -> Result:
+        runner = self._runners.get()
+        try:
+            return runner.run(command)
+        finally:
+            self._runners.put(runner)
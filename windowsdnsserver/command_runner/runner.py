@@ -12,6 +12,12 @@ class CommandRunner(object):
     def run(self, cmd: Command):
         raise MethodNotImplementedError()
 
+    async def run_async(self, cmd: Command):
+        raise MethodNotImplementedError()
+
+    def close(self):
+        pass
+
 
 class Result(object):
 
@@ -1,28 +1,45 @@
+import concurrent.futures
 import json
 import logging
 import platform
-from typing import List
+import time
+from typing import Dict, List, Optional, Tuple
 
-from windowsdnsserver.command_runner.powershell_runner import PowerShellCommand, PowerShellRunner
-from windowsdnsserver.command_runner.runner import Command, CommandRunner
+from windowsdnsserver.command_runner.powershell_runner import PowerShellCommand, PowerShellRunner, PowerShellRunnerPool
+from windowsdnsserver.command_runner.runner import Command, CommandRunner, Result
 from windowsdnsserver.util import logger
 from .base import DNSService
-from .record import RecordType, Record
+from .record import RecordType, Record, RecordBatch
 from ..util import dns_server_utils
 
+# neither changes while the process is running
+PLATFORM_SYSTEM = platform.system()
+PLATFORM_NODE = platform.node()
+
+# Windows limits a command line to 32767 characters. A script run in its own process is passed as
+# -EncodedCommand, base64 of UTF-16LE, which takes 8/3 characters per script character, so
+# apply_batch keeps each script below 10000 characters to leave room for the executable and flags.
+MAX_BATCH_SCRIPT_LENGTH = 10000
+
 
 class DnsServerModule(DNSService):
     """
         Wrapper of Windows-DnsServer powershell module
 
         https://docs.microsoft.com/en-us/powershell/module/dnsserver/?view=win10-ps
+
+        results of get_dns_records are cached for cache_ttl seconds, records added or
+        removed through this module invalidate the cache. Set cache_ttl to 0 to disable it.
+        Returned lists are copies, the Record objects in them are shared and read-only.
     """
 
-    def __init__(self, runner: CommandRunner = None, logger_service=None, server=None):
+    def __init__(self, runner: CommandRunner = None, logger_service=None, server=None, cache_ttl: float = 5.0):
         super().__init__()
 
-        assert platform.system() == 'Windows', "DnsServerModule can run only on a Windows Server"
+        assert PLATFORM_SYSTEM == 'Windows', "DnsServerModule can run only on a Windows Server"
         self.server = server
+        # -Computer opens a CIM session even when it names this machine, so it is passed only for remote servers
+        self._is_local = not server or server.lower() in (PLATFORM_NODE.lower(), 'localhost')
 
         if logger_service is None:
             self.logger = logger.create_logger("DnsServer")
@@ -33,116 +50,66 @@ class DnsServerModule(DNSService):
         if runner is None:
             self.runner = PowerShellRunner(logger_service=self.logger)
 
+        self._cache_ttl = cache_ttl
+        self._get_cache: Dict[tuple, Tuple[float, List[Record]]] = {}
+
+        self._module_installed: Optional[bool] = None
+
     def get_dns_records(self, zone: str, name: str = None, record_type: RecordType = None) -> List[Record]:
         """ uses Get-DnsServerResourceRecord cmdlet to get records in a zone """
+        key = self._cache_key(zone, name, record_type)
 
-        args = {
-            'ZoneName': zone,
-        }
+        records = self._get_cached_records(key)
+        if records is not None:
+            return records
 
-        if self.server:
-            args['Computer'] = self.server
+        result = self.run(self._build_get_command(zone, name, record_type))
+        return self._parse_records(zone, key, result)
 
-        if name:
-            args['Name'] = name
-        if record_type:
-            args['RRType'] = record_type.value
+    def get_dns_record_batch(self, zone: str, name: str = None, record_type: RecordType = None) -> RecordBatch:
+        """
+            same as get_dns_records, but records are collected into a RecordBatch without creating
+            a Record per record, meant for large zones. Results are not cached.
+        """
+        result = self.run(self._build_get_command(zone, name, record_type))
+        if not result.success or not result.out.strip():
+            return RecordBatch(zone)
 
-        command = PowerShellCommand('Get-DnsServerResourceRecord', to_json_convert=True, **args)
-        result = self.run(command)
-        if result.success:
-            json_result = json.loads(result.out)
-            return dns_server_utils.transform_dns_server_result(zone, json_result)
-        else:
-            return []
+        return dns_server_utils.transform_dns_server_result_to_batch(zone, json.loads(result.out))
 
     def add_a_record(self, zone: str, name: str, ip: str, ttl: str = None) -> bool:
         """ uses Add-DnsServerResourceRecordA cmdlet to add a resource in a zone """
-        args = {
-            'ZoneName': zone,
-            'Name': name,
-            'IPv4Address': ip,
-        }
-
-        if self.server:
-            args['Computer'] = self.server
-
-        if ttl:
-            args['TimeToLive'] = dns_server_utils.format_ttl(ttl)
-
-        command = PowerShellCommand(
-            'Add-DnsServerResourceRecordA',
-            'AllowUpdateAny',
-            to_json_convert=False,
-            *args
-        )
+        command = self._build_op_command(self._build_add_op(RecordType.A, zone, name, ip, ttl))
 
         result = self.run(command)
+        self._invalidate_cache(zone, name)
         return result.success
 
     def remove_a_record(self, zone: str, name: str) -> bool:
         """ uses Remove-DnsServerResourceRecord cmdlet to remove a record in a zone """
+        command = self._build_op_command(self._build_remove_op(RecordType.A, zone, name))
 
-        args = {
-            'ZoneName': zone,
-            'RRType': 'A',
-        }
-        if self.server:
-            args['Computer'] = self.server
-
-        if name:
-            args['Name'] = name
-
-        flags = ['Force']
-
-        command = PowerShellCommand('Remove-DnsServerResourceRecord', *flags, to_json_convert=False, **args)
         result = self.run(command)
+        self._invalidate_cache(zone, name)
 
         return result.success
 
     def add_cname_record(self, zone: str, alias_name: str, server_name: str, ttl: str = None) -> bool:
         """ uses Add-DnsServerResourceRecordA cmdlet to add a resource in a zone """
-        args = {
-            'ZoneName': zone,
-            'Name': alias_name,
-            'HostNameAlias': f'"{server_name}"',
-        }
-        if self.server:
-            args['Computer'] = self.server
-
-        if ttl:
-            args['TimeToLive'] = dns_server_utils.format_ttl(ttl)
-
-        command = PowerShellCommand(
-            'Add-DnsServerResourceRecordCName',
-            # 'AllowUpdateAny',
-            to_json_convert=False,
-            **args
-        )
+        command = self._build_op_command(self._build_add_op(RecordType.CNAME, zone, alias_name, server_name, ttl))
 
         result = self.run(command)
+        self._invalidate_cache(zone, alias_name)
         if not result.success:
-            logging.error(result.out)
-            logging.error(result.err)
+            self.logger.error("out: [%s], err: [%s]", result.out, result.err)
         return result.success
 
     def remove_cname_record(self, zone: str, alias_name: str) -> bool:
         """ uses Remove-DnsServerResourceRecord cmdlet to remove a record in a zone """
+        command = self._build_op_command(self._build_remove_op(RecordType.CNAME, zone, alias_name))
 
-        args = {
-            'ZoneName': zone,
-            'RRType': 'CNAME',
-        }
-        if self.server:
-            args['Computer'] = self.server
-
-        if alias_name:
-            args['Name'] = alias_name
-
-        flags = ['Force']
-
-        command = PowerShellCommand('Remove-DnsServerResourceRecord', *flags, to_json_convert=False, **args)
         result = self.run(command)
+        self._invalidate_cache(zone, alias_name)
 
         return result.success
 
@@ -150,57 +117,324 @@ class DnsServerModule(DNSService):
 
     def add_txt_record(self, zone: str, name: str, content, ttl: str = '1h') -> bool:
         """ uses Add-DnsServerResourceRecord cmdlet to add txt resource in a zone """
-
-        command = PowerShellCommand(
-            'Add-DnsServerResourceRecord',
-            'AllowUpdateAny',
-            'Txt',
-            to_json_convert=False,
-            ZoneName=zone,
-            Name=name,
-            DescriptiveText=content,
-            TimeToLive=dns_server_utils.format_ttl(ttl)
-        )
+        command = self._build_op_command(self._build_add_op(RecordType.TXT, zone, name, content, ttl))
 
         result = self.run(command)
+        self._invalidate_cache(zone, name)
 
         return result.success
 
     def remove_txt_record(self, zone: str, name: str, record_data: str = None) -> bool:
         """ uses Remove-DnsServerResourceRecord cmdlet to remove txt record in a zone """
+        command = self._build_op_command(self._build_remove_op(RecordType.TXT, zone, name, record_data))
+
+        result = self.run(command)
+        self._invalidate_cache(zone, name)
+
+        return result.success
+
+    # -- asyncio versions of the methods above, commands are run with runner.run_async
+
+    async def aget_dns_records(self, zone: str, name: str = None, record_type: RecordType = None) -> List[Record]:
+        key = self._cache_key(zone, name, record_type)
+
+        records = self._get_cached_records(key)
+        if records is not None:
+            return records
+
+        result = await self.arun(self._build_get_command(zone, name, record_type))
+        return self._parse_records(zone, key, result)
+
+    async def aadd_a_record(self, zone: str, name: str, ip: str, ttl: str = None) -> bool:
+        command = self._build_op_command(self._build_add_op(RecordType.A, zone, name, ip, ttl))
+
+        result = await self.arun(command)
+        self._invalidate_cache(zone, name)
+        return result.success
+
+    async def aremove_a_record(self, zone: str, name: str) -> bool:
+        command = self._build_op_command(self._build_remove_op(RecordType.A, zone, name))
+
+        result = await self.arun(command)
+        self._invalidate_cache(zone, name)
+        return result.success
+
+    async def aadd_cname_record(self, zone: str, alias_name: str, server_name: str, ttl: str = None) -> bool:
+        command = self._build_op_command(self._build_add_op(RecordType.CNAME, zone, alias_name, server_name, ttl))
+
+        result = await self.arun(command)
+        self._invalidate_cache(zone, alias_name)
+        if not result.success:
+            self.logger.error("out: [%s], err: [%s]", result.out, result.err)
+        return result.success
+
+    async def aremove_cname_record(self, zone: str, alias_name: str) -> bool:
+        command = self._build_op_command(self._build_remove_op(RecordType.CNAME, zone, alias_name))
+
+        result = await self.arun(command)
+        self._invalidate_cache(zone, alias_name)
+        return result.success
+
+    async def aadd_txt_record(self, zone: str, name: str, content, ttl: str = '1h') -> bool:
+        command = self._build_op_command(self._build_add_op(RecordType.TXT, zone, name, content, ttl))
+
+        result = await self.arun(command)
+        self._invalidate_cache(zone, name)
+        return result.success
+
+    async def aremove_txt_record(self, zone: str, name: str, record_data: str = None) -> bool:
+        command = self._build_op_command(self._build_remove_op(RecordType.TXT, zone, name, record_data))
+
+        result = await self.arun(command)
+        self._invalidate_cache(zone, name)
+        return result.success
 
+    # --
+
+    def apply_batch(self, operations: list) -> List[bool]:
+        """
+            runs several cmdlets in a single PowerShell invocation, large batches are split
+            into as few invocations as fit on a command line
+
+            each operation is a (cmdlet, args, flags) tuple, ie
+            ('Add-DnsServerResourceRecordA', {'ZoneName': 'myzone.com', 'Name': 'www', 'IPv4Address': '10.0.0.1'},
+            ['AllowUpdateAny'])
+
+            a failing operation does not stop the rest of the batch
+
+            :return: success of each operation, in the order of given operations
+        """
+        if not operations:
+            return []
+
+        op_commands = []
+        scripts = []
+        for cmdlet, args, flags in operations:
+            # make errors terminating, so that they can be caught per operation
+            op = PowerShellCommand(cmdlet, *flags, **dict(args, ErrorAction='Stop'))
+            op_commands.append(op)
+
+            # output of the cmdlet is dropped, only the success markers are returned
+            scripts.append('try { %s | Out-Null; $true } catch { $false }' % ' '.join(op.build()))
+
+        # split into chunks that fit on a command line, see MAX_BATCH_SCRIPT_LENGTH
+        op_results = []
+        start = 0
+        while start < len(scripts):
+            end = start + 1
+            length = len(scripts[start])
+            while end < len(scripts) and length + len('; ') + len(scripts[end]) <= MAX_BATCH_SCRIPT_LENGTH:
+                length += len('; ') + len(scripts[end])
+                end += 1
+
+            op_results.extend(self._apply_batch_chunk(op_commands[start:end], scripts[start:end]))
+            start = end
+
+        for _, args, _ in operations:
+            self._invalidate_cache(args.get('ZoneName'), args.get('Name'))
+
+        return op_results
+
+    def _apply_batch_chunk(self, op_commands: list, scripts: list) -> List[bool]:
+        command = PowerShellCommand('& { %s }' % '; '.join(scripts), to_json_convert=True)
+
+        # caught errors still fail the command, failures are logged per operation below instead
+        result = self.run(command, log_failure=False)
+
+        # caught errors are still reported, so the output is checked even if the command failed
+        try:
+            json_result = json.loads(result.out)
+        except ValueError:
+            json_result = None
+
+        if not isinstance(json_result, list):
+            json_result = [json_result]
+
+        if len(json_result) != len(op_commands):
+            self.logger.error("Batch of [%s] operations failed, out: [%s], err: [%s]",
+                              len(op_commands), result.out, result.err)
+            return [False] * len(op_commands)
+
+        op_results = [op_result is True for op_result in json_result]
+        for op, op_result in zip(op_commands, op_results):
+            if not op_result:
+                self._log_failure(op)
+
+        return op_results
+
+    def add_a_records_bulk(self, items: list) -> List[bool]:
+        """
+            adds several A records, each item is a (zone, name, ip) or (zone, name, ip, ttl) tuple
+
+            records are added concurrently when runner is a PowerShellRunnerPool, one by one otherwise
+
+            :return: success of each item, in the order of given items
+        """
+        items = list(items)
+
+        commands = [self._build_op_command(self._build_add_op(RecordType.A, *item)) for item in items]
+
+        if isinstance(self.runner, PowerShellRunnerPool):
+            futures = [self.runner.submit(command) for command in commands]
+            concurrent.futures.wait(futures)
+
+            results = [future.result() for future in futures]
+            for command, result in zip(commands, results):
+                if not result.success:
+                    self._log_failure(command)
+        else:
+            results = [self.run(command) for command in commands]
+
+        for item in items:
+            self._invalidate_cache(item[0], item[1])
+
+        return [result.success for result in results]
+
+    def _build_add_op(self, record_type: RecordType, zone: str, name: str, content: str, ttl: str = None) -> tuple:
+        """ builds (cmdlet, args, flags) of the operation that adds a record, see apply_batch """
+        args = {
+            'ZoneName': zone,
+            'Name': name,
+        }
+
+        if record_type == RecordType.A:
+            cmdlet = 'Add-DnsServerResourceRecordA'
+            flags = ['AllowUpdateAny']
+            args['IPv4Address'] = content
+        elif record_type == RecordType.CNAME:
+            cmdlet = 'Add-DnsServerResourceRecordCName'
+            flags = []
+            args['HostNameAlias'] = content
+        elif record_type == RecordType.TXT:
+            cmdlet = 'Add-DnsServerResourceRecord'
+            flags = ['AllowUpdateAny', 'Txt']
+            args['DescriptiveText'] = content
+        else:
+            raise ValueError("unsupported record type [%s]" % record_type)
+
+        if not self._is_local:
+            args['Computer'] = self.server
+
+        if ttl:
+            args['TimeToLive'] = dns_server_utils.format_ttl(ttl)
+
+        return cmdlet, args, flags
+
+    def _build_remove_op(self, record_type: RecordType, zone: str, name: str, record_data: str = None) -> tuple:
+        """ builds (cmdlet, args, flags) of the operation that removes a record, see apply_batch """
         args = {
             'ZoneName': zone,
-            'RRType': 'Txt',
+            'RRType': record_type.value,
         }
-        if self.server:
+        if not self._is_local:
             args['Computer'] = self.server
 
         if name:
             args['Name'] = name
 
         if record_data:
-            args['RecordData'] = '"%s"' % record_data
+            args['RecordData'] = record_data
 
-        flags = ['Force']
+        return 'Remove-DnsServerResourceRecord', args, ['Force']
 
-        command = PowerShellCommand('Remove-DnsServerResourceRecord', *flags, **args)
-        result = self.run(command)
+    @staticmethod
+    def _build_op_command(op: tuple) -> PowerShellCommand:
+        cmdlet, args, flags = op
+        return PowerShellCommand(cmdlet, *flags, to_json_convert=False, **args)
 
-        return result.success
+    def _build_get_command(self, zone: str, name: str = None, record_type: RecordType = None) -> PowerShellCommand:
+        args = {
+            'ZoneName': zone,
+        }
+
+        if not self._is_local:
+            args['Computer'] = self.server
+
+        if name:
+            args['Name'] = name
+        if record_type:
+            args['RRType'] = record_type.value
+
+        return PowerShellCommand('Get-DnsServerResourceRecord', to_json_convert=True, **args)
+
+    def _parse_records(self, zone: str, key: tuple, result: Result) -> List[Record]:
+        if not result.success:
+            return []
+
+        if result.out.strip():
+            records = dns_server_utils.transform_dns_server_result(zone, json.loads(result.out))
+        else:
+            # nothing matched, ConvertTo-Json writes no output for an empty pipeline
+            records = []
+        if self._cache_ttl > 0:
+            self._get_cache[key] = (time.monotonic(), records)
+
+        return list(records)
+
+    def _get_cached_records(self, key: tuple) -> Optional[List[Record]]:
+        cached = self._get_cache.get(key)
+        if cached is None:
+            return None
+
+        timestamp, records = cached
+        if time.monotonic() - timestamp >= self._cache_ttl:
+            return None
+
+        return list(records)
+
+    @staticmethod
+    def _cache_key(zone: str, name: str = None, record_type: RecordType = None) -> tuple:
+        # DNS names are case-insensitive
+        return zone.lower(), name.lower() if name else None, record_type.value if record_type else None
+
+    def _invalidate_cache(self, zone: str = None, name: str = None):
+        """ drops cached results that may contain given record, all of them if zone is not known """
+        zone = zone.lower() if zone else None
+        name = name.lower() if name else None
+
+        for key in list(self._get_cache):
+            cached_zone, cached_name, _ = key
+            if zone is not None and cached_zone != zone:
+                continue
+
+            if name is not None and cached_name is not None and cached_name != name:
+                continue
+
+            self._get_cache.pop(key, None)
 
     # --
 
     def is_dns_server_module_installed(self):
-        command = PowerShellCommand('Get-Module DNSServer', 'ListAvailable')
-        result = self.run(command)
+        """ checks DNSServer module, the result of the first successful check is reused afterwards """
+        if self._module_installed is None:
+            command = PowerShellCommand('Get-Module DNSServer', 'ListAvailable')
+            result = self.run(command)
+
+            if not result.success:
+                # the check itself failed, ie host timed out, try again on the next call
+                return False
 
-        return result.success and len(result.out) > 0
+            self._module_installed = len(result.out) > 0
 
-    def run(self, command: Command):
+        return self._module_installed
+
+    def run(self, command: Command, log_failure: bool = True):
         result = self.runner.run(command)
 
+        if log_failure and not result.success:
+            self._log_failure(command)
+
+        return result
+
+    def _log_failure(self, command: Command):
+        # building the command line is skipped when errors are not logged anyway
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error("Command failed [%s]", command.build())
+
+    async def arun(self, command: Command):
+        result = await self.runner.run_async(command)
+
         if not result.success:
-            self.logger.error("Command failed [%s]" % command.build())
+            self._log_failure(command)
 
         return result
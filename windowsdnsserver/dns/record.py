@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import Iterable, Iterator, List
 
 
 class RecordType(Enum):
@@ -16,13 +17,80 @@ class RecordType(Enum):
 
 
 class Record(object):
+    """
+        A DNS record. Records are read-only, they may be shared between callers, ie by the
+        DnsServerModule results cache.
+    """
+    __slots__ = ('zone', 'name', 'type', 'content', 'ttl')
 
     def __init__(self, zone: str, name: str, record_type: RecordType, content: str, ttl: str = '1h'):
-        self.zone = zone
-        self.name = name
-        self.type = record_type
-        self.content = content
-        self.ttl = ttl
+        object.__setattr__(self, 'zone', zone)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'type', record_type)
+        object.__setattr__(self, 'content', content)
+        object.__setattr__(self, 'ttl', ttl)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Record is read-only, can not set [%s]" % key)
+
+    def __delattr__(self, key):
+        raise AttributeError("Record is read-only, can not delete [%s]" % key)
 
     def __repr__(self):
         return '[%s] record - zone: [%s], name: [%s]' % (self.type, self.zone, self.name)
+
+
+class RecordBatch(object):
+    """
+        Records of a zone stored column by column, ie names[i], types[i], contents[i] and ttls[i]
+        belong to the same record. Takes less memory than a list of Record for large zones.
+    """
+    __slots__ = ('zone', 'names', 'types', 'contents', 'ttls')
+
+    def __init__(self, zone: str):
+        self.zone = zone
+        self.names: List[str] = []
+        self.types: List[RecordType] = []
+        self.contents: List[str] = []
+        self.ttls: List[str] = []
+
+    @classmethod
+    def from_records(cls, zone: str, records: Iterable[Record]):
+        batch = cls(zone)
+        for record in records:
+            batch.append(record.name, record.type, record.content, record.ttl)
+
+        return batch
+
+    @classmethod
+    def from_json_stream(cls, zone: str, cmdlet_results: Iterable[dict]):
+        """
+            builds a batch from Get-DnsServerResourceRecord output, records are consumed one by one,
+            so any iterable of records works, ie a generator of a streaming JSON parser
+        """
+        # dns_server_utils depends on this module
+        from ..util.dns_server_utils import parse_dns_server_record
+
+        batch = cls(zone)
+        for result in cmdlet_results:
+            fields = parse_dns_server_record(result)
+            if fields is not None:
+                batch.append(*fields)
+
+        return batch
+
+    def append(self, name: str, record_type: RecordType, content: str, ttl: str):
+        self.names.append(name)
+        self.types.append(record_type)
+        self.contents.append(content)
+        self.ttls.append(ttl)
+
+    def records(self) -> Iterator[Record]:
+        for name, record_type, content, ttl in zip(self.names, self.types, self.contents, self.ttls):
+            yield Record(self.zone, name, record_type, content, ttl)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return 'record batch - zone: [%s], records: [%s]' % (self.zone, len(self))
@@ -1,8 +1,10 @@
+import functools
 from collections.abc import Iterable
 
-from ..dns.record import Record, RecordType
+from ..dns.record import Record, RecordBatch, RecordType
 
 
+@functools.lru_cache(maxsize=64)
 def format_ttl(ttl):
     """
     format_ttl converts given ttl string to Windows-DnsServer module's
@@ -85,29 +87,69 @@ def transform_dns_server_result(zone, cmdlet_results):
 
     record_results = []
     for result in cmdlet_results:
-        name = result['HostName']
-        record_type = result['RecordType']
+        record = transform_dns_server_record(zone, result)
+        if record is not None:
+            record_results.append(record)
 
-        if not is_record_type_supported(record_type):
-            continue
+    return record_results
 
-        record_data_props = result['RecordData']['CimInstanceProperties']
 
-        record_data = dict()
-        if isinstance(record_data_props, str):
-            key, value = record_data_props.split('=')
-            # value's has quotes at beginning and end of value -- remove it
-            record_data[key.strip()] = value[1:-1]
-        else:
-            for props in record_data_props:
-                key, value = props.split('=')
-                record_data[key.strip()] = value
+def transform_dns_server_result_to_batch(zone, cmdlet_results):
+    """
+    same as transform_dns_server_result, but records are collected into a RecordBatch
 
-        assert len(record_data) < 2, "Unexpected data record, expected only one property, actual: [%s]" % record_data
+    :param zone: zone of the records
+    :param cmdlet_results: Get-DnsServerResourceRecord output
+    :return: RecordBatch
+    """
+    # a single record is not wrapped in an array by ConvertTo-Json
+    if isinstance(cmdlet_results, dict):
+        cmdlet_results = [cmdlet_results]
 
-        content = next(iter(record_data.values()))
-        ttl = parse_ttl(result['TimeToLive'])
+    return RecordBatch.from_json_stream(zone, cmdlet_results)
 
-        record_results.append(Record(zone, name, RecordType.value_of(record_type), content, ttl))
 
-    return record_results
+def transform_dns_server_record(zone, cmdlet_result):
+    """
+
+    :param zone: zone of the record
+    :param cmdlet_result: a single record of Get-DnsServerResourceRecord output
+    :return: Record, or None if the record type is not supported
+    """
+    fields = parse_dns_server_record(cmdlet_result)
+    if fields is None:
+        return None
+
+    return Record(zone, *fields)
+
+
+def parse_dns_server_record(cmdlet_result):
+    """
+
+    :param cmdlet_result: a single record of Get-DnsServerResourceRecord output
+    :return: (name, record type, content, ttl), or None if the record type is not supported
+    """
+    name = cmdlet_result['HostName']
+    record_type = cmdlet_result['RecordType']
+
+    if not is_record_type_supported(record_type):
+        return None
+
+    record_data_props = cmdlet_result['RecordData']['CimInstanceProperties']
+
+    record_data = dict()
+    if isinstance(record_data_props, str):
+        key, value = record_data_props.split('=')
+        # value's has quotes at beginning and end of value -- remove it
+        record_data[key.strip()] = value[1:-1]
+    else:
+        for props in record_data_props:
+            key, value = props.split('=')
+            record_data[key.strip()] = value
+
+    assert len(record_data) < 2, "Unexpected data record, expected only one property, actual: [%s]" % record_data
+
+    content = next(iter(record_data.values()))
+    ttl = parse_ttl(cmdlet_result['TimeToLive'])
+
+    return name, RecordType.value_of(record_type), content, ttl